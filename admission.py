@@ -0,0 +1,223 @@
+# التحكم في القبول حسب هدف زمن الاستجابة (SLO) مع فئات أولوية
+#
+# - يُقاس زمن التوليد الفعلي (الكامل والمخفف كل على حدة) بمتوسط أسي متحرك، ولا تُحتسب
+#   الطلبات التي لم تشغّل generate (إعادة استخدام وصف مفهرس، بحث التشابه، الأخطاء).
+# - عند وصول طلب يُقدَّر زمن انتظاره في الطابور، فإن كان سيتجاوز هدف فئته يُخفَّف
+#   إلى توليد أرخص، وإن تجاوزه حتى مع التخفيف يُرفض مبكراً بدلاً من إبطاء الجميع.
+# - للطلبات التفاعلية والدفعية طوابير منفصلة تُجدول بعدالة موزونة (stride scheduling).
+#
+# المتحكم خاص بالعملية التي تملك الاستدلال: خادم الواجهة عند تحميل النموذج محلياً، أو عامل
+# الاستدلال المنفصل (inference_server.py) الذي يشترك فيه كل خوادم الواجهة المتصلة به، وعندها
+# تستخدم الواجهات DeferredAdmission وتمرر الأولوية فقط. مع النموذج المحلي و gunicorn -w N يوجد
+# N متحكماً لا يرى أحدها طوابير الآخر، فيُفضّل وضع ASGI بعملية واحدة أو العامل المنفصل.
+
+import math
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+INTERACTIVE = 'interactive'
+BATCH = 'batch'
+PRIORITIES = (INTERACTIVE, BATCH)
+
+
+class Overloaded(Exception):
+    """الطلب سيتجاوز هدف زمن الاستجابة حتى مع التوليد المخفف"""
+
+    def __init__(self, retry_after):
+        super().__init__(f'retry after {retry_after}s')
+        self.retry_after = retry_after
+
+
+class LatencyEstimator:
+    """متوسط أسي متحرك لزمن الخدمة لكل نمط توليد"""
+
+    def __init__(self, initial=1.5, alpha=0.2, fast_ratio=0.25):
+        # تقديرات أولية قبل توفر قياسات، حتى لا يُقبل كل شيء عند بدء التشغيل
+        self.initial = initial
+        self.alpha = alpha
+        self.fast_ratio = fast_ratio
+        self._mean = {False: None, True: None}
+
+    def record(self, fast, seconds):
+        mean = self._mean[fast]
+        self._mean[fast] = seconds if mean is None else mean + self.alpha * (seconds - mean)
+
+    def estimate(self, fast):
+        mean = self._mean[fast]
+        if mean is not None:
+            return mean
+        full = self._mean[False] if self._mean[False] is not None else self.initial
+        return full * self.fast_ratio if fast else full
+
+
+class Ticket:
+    """حجز لمكان تنفيذ: يُمنح فوراً أو عند دوره في الطابور"""
+
+    def __init__(self, priority, fast):
+        self.priority = priority
+        self.fast = fast
+        self.granted_at = None
+        # زمن generate الفعلي إن نجح، وهو وحده ما يُسجل في المقدّر
+        self.service_time = None
+        self._ready = threading.Event()
+        self._callbacks = []
+        self._callbacks_lock = threading.Lock()
+
+    def wait(self):
+        self._ready.wait()
+
+    def add_done_callback(self, callback):
+        """استدعاء callback عند المنح (فوراً إذا كان ممنوحاً)"""
+        with self._callbacks_lock:
+            if not self._ready.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def _set_ready(self):
+        with self._callbacks_lock:
+            self._ready.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback()
+
+
+class AdmissionController:
+    """قبول أو تخفيف أو رفض الطلبات وجدولتها بين فئات الأولوية"""
+
+    def __init__(self, concurrency=1, slo=None, weights=None, initial_latency=1.5):
+        self.concurrency = concurrency
+        self.slo = slo or {INTERACTIVE: 5.0, BATCH: 60.0}
+        self.weights = weights or {INTERACTIVE: 4, BATCH: 1}
+        self.estimator = LatencyEstimator(initial_latency)
+        self._lock = threading.Lock()
+        self._queues = {priority: deque() for priority in PRIORITIES}
+        self._pass = {priority: 0.0 for priority in PRIORITIES}
+        self._in_service = 0
+
+    @classmethod
+    def from_env(cls, concurrency=1):
+        """الإعداد من المتغيرات البيئية (concurrency هي سعة التنفيذ الافتراضية لهذه العملية)"""
+        return cls(
+            concurrency=int(os.getenv('INFERENCE_CONCURRENCY', concurrency)),
+            slo={
+                INTERACTIVE: float(os.getenv('SLO_INTERACTIVE_MS', '5000')) / 1000,
+                BATCH: float(os.getenv('SLO_BATCH_MS', '60000')) / 1000,
+            },
+            weights={
+                INTERACTIVE: float(os.getenv('INTERACTIVE_WEIGHT', '4')),
+                BATCH: float(os.getenv('BATCH_WEIGHT', '1')),
+            },
+            initial_latency=float(os.getenv('INITIAL_LATENCY_MS', '1500')) / 1000,
+        )
+
+    def _queued_ahead(self, priority):
+        """عدد الطلبات التي ستُخدم قبل طلب جديد في هذه الفئة تحت الجدولة الموزونة"""
+        own = len(self._queues[priority])
+        ahead = own
+        for other in PRIORITIES:
+            if other != priority:
+                share = (own + 1) * self.weights[other] / self.weights[priority]
+                ahead += min(len(self._queues[other]), share)
+        return ahead
+
+    def _estimated_wait(self, priority):
+        if self._in_service < self.concurrency and not any(self._queues.values()):
+            return 0.0
+        # نصف زمن خدمة تقريباً متبقٍ لكل طلب قيد التنفيذ
+        service = self.estimator.estimate(False)
+        return (self._queued_ahead(priority) + 0.5) * service / self.concurrency
+
+    def reserve(self, priority):
+        """حجز مكان أو إدخال الطابور، أو رفع Overloaded"""
+        with self._lock:
+            wait = self._estimated_wait(priority)
+            slo = self.slo[priority]
+            if wait + self.estimator.estimate(False) <= slo:
+                fast = False
+            elif wait + self.estimator.estimate(True) <= slo:
+                fast = True
+            else:
+                raise Overloaded(max(1, math.ceil(wait)))
+
+            ticket = Ticket(priority, fast)
+            if self._in_service < self.concurrency and not any(self._queues.values()):
+                self._grant(ticket)
+            else:
+                if not self._queues[priority]:
+                    # فئة عائدة من الخمول لا تكتسب رصيداً متراكماً
+                    active = [self._pass[p] for p in PRIORITIES if self._queues[p]]
+                    if active:
+                        self._pass[priority] = max(self._pass[priority], min(active))
+                self._queues[priority].append(ticket)
+        if ticket.granted_at is not None:
+            ticket._set_ready()
+        return ticket
+
+    def release(self, ticket):
+        """إنهاء الطلب (أو إلغاؤه من الطابور) وتسجيل زمن توليده إن وُجد"""
+        granted = []
+        with self._lock:
+            if ticket.granted_at is None:
+                try:
+                    self._queues[ticket.priority].remove(ticket)
+                except ValueError:
+                    pass
+                return
+            if ticket.service_time is not None:
+                self.estimator.record(ticket.fast, ticket.service_time)
+            self._in_service -= 1
+            while self._in_service < self.concurrency:
+                next_ticket = self._next()
+                if next_ticket is None:
+                    break
+                self._grant(next_ticket)
+                granted.append(next_ticket)
+        for next_ticket in granted:
+            next_ticket._set_ready()
+
+    def _next(self):
+        """الفئة غير الفارغة ذات أقل تقدم موزون"""
+        active = [p for p in PRIORITIES if self._queues[p]]
+        if not active:
+            return None
+        priority = min(active, key=lambda p: self._pass[p])
+        self._pass[priority] += 1 / self.weights[priority]
+        return self._queues[priority].popleft()
+
+    def _grant(self, ticket):
+        self._in_service += 1
+        ticket.granted_at = time.monotonic()
+
+    @contextmanager
+    def admit(self, priority):
+        """حجز وانتظار الدور ثم التحرير عند الانتهاء"""
+        ticket = self.reserve(priority)
+        try:
+            ticket.wait()
+            yield ticket
+        finally:
+            self.release(ticket)
+
+
+class DeferredAdmission:
+    """واجهة AdmissionController لخوادم الواجهة عندما يتولى عامل الاستدلال المنفصل القبول
+
+    تُمنح التذكرة فوراً وتحمل الأولوية إلى العامل، الذي يحدد نمط التوليد (ticket.fast) أو يرفض الطلب.
+    """
+
+    def reserve(self, priority):
+        ticket = Ticket(priority, False)
+        ticket.granted_at = time.monotonic()
+        ticket._set_ready()
+        return ticket
+
+    def release(self, ticket):
+        pass
+
+    @contextmanager
+    def admit(self, priority):
+        yield self.reserve(priority)
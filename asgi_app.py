@@ -0,0 +1,215 @@
+# وضع تقديم غير متزامن (ASGI) بنفس واجهات /api/describe و /api/describe_url و /api/similar
+#
+# التشغيل:
+#   uvicorn asgi_app:app --host 0.0.0.0 --port 8000
+#
+# قراءة الملفات المرفوعة وتحميل الروابط تتم عبر coroutines لا تحجز أي خيط،
+# بينما تُرسل معالجة الصورة والاستدلال إلى منفذ (executor) بعدد ثابت وصغير من الخيوط.
+# للعملية متحكم قبول خاص بها سعته الافتراضية عدد خيوط المنفذ (أو يتولاه عامل الاستدلال المنفصل).
+
+import asyncio
+import contextlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+import httpx
+from PIL import Image
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+from admission import INTERACTIVE, PRIORITIES, AdmissionController, DeferredAdmission, Overloaded
+from captioning_service import (
+    inference_client,
+    embedding_index,
+    model_ready,
+    describe_image_bilingual,
+    find_similar_images,
+    parse_k,
+)
+
+INFERENCE_THREADS = int(os.getenv('INFERENCE_THREADS', '2'))
+FETCH_TIMEOUT_SECONDS = float(os.getenv('FETCH_TIMEOUT_SECONDS', '30'))
+MAX_FETCH_CONNECTIONS = int(os.getenv('MAX_FETCH_CONNECTIONS', '1000'))
+
+inference_executor = ThreadPoolExecutor(
+    max_workers=INFERENCE_THREADS, thread_name_prefix='inference'
+)
+http_client = None
+# مع عامل الاستدلال المنفصل يتولى العامل القبول، وإلا فسعة هذه العملية عدد خيوط المنفذ
+admission = (
+    DeferredAdmission() if inference_client is not None
+    else AdmissionController.from_env(INFERENCE_THREADS)
+)
+
+
+def _describe_bytes(ticket, content, source):
+    """فك ترميز الصورة ووصفها باللغتين (يعمل داخل منفذ الاستدلال)"""
+    image = Image.open(BytesIO(content)).convert('RGB')
+    english_desc, arabic_desc = describe_image_bilingual(image, ticket, source)
+    return {
+        'english': english_desc,
+        'arabic': arabic_desc,
+        'degraded': ticket.fast,
+        'success': True
+    }
+
+
+def _similar_bytes(ticket, content, k):
+    """فك ترميز الصورة والبحث عن أقرب k صورة (يعمل داخل منفذ الاستدلال)"""
+    image = Image.open(BytesIO(content)).convert('RGB')
+    return {'similar': find_similar_images(image, k, ticket), 'success': True}
+
+
+def _wake(future):
+    """إيقاظ الطلب المنتظر إن لم يُلغَ"""
+    if not future.done():
+        future.set_result(None)
+
+
+def _request_priority(request):
+    """فئة أولوية الطلب من الترويسة X-Priority (افتراضياً تفاعلي)، أو None إذا كانت غير معروفة"""
+    priority = request.headers.get('x-priority', INTERACTIVE).strip().lower()
+    return priority if priority in PRIORITIES else None
+
+
+def _overloaded_response(e):
+    """استجابة 503 مع Retry-After عند رفض الطلب مبكراً"""
+    return JSONResponse(
+        {'error': 'الخدمة مشغولة حالياً، يرجى المحاولة لاحقاً', 'retry_after': e.retry_after},
+        status_code=503,
+        headers={'Retry-After': str(e.retry_after)},
+    )
+
+
+async def _run_admitted(priority, function, *args):
+    """انتظار الدور في التحكم بالقبول دون حجز خيط، ثم تنفيذ function(ticket, *args) في منفذ الاستدلال"""
+    ticket = admission.reserve(priority)
+
+    loop = asyncio.get_running_loop()
+    try:
+        granted = loop.create_future()
+        ticket.add_done_callback(lambda: loop.call_soon_threadsafe(_wake, granted))
+        await granted
+        future = inference_executor.submit(function, ticket, *args)
+    except BaseException:
+        # أُلغي الطلب قبل إرسال العمل إلى المنفذ
+        admission.release(ticket)
+        raise
+
+    # التحرير عند انتهاء العمل فعلياً، لا عند إلغاء الطلب بينما الخيط ما زال يعمل
+    future.add_done_callback(lambda _: admission.release(ticket))
+    return await asyncio.wrap_future(future)
+
+
+async def describe_image(request):
+    """API لوصف الصورة"""
+    try:
+        form = await request.form()
+        file = form.get('image')
+        if file is None or isinstance(file, str):
+            return JSONResponse({'error': 'لم يتم إرسال صورة'}, status_code=400)
+        if file.filename == '':
+            return JSONResponse({'error': 'لم يتم اختيار ملف'}, status_code=400)
+
+        priority = _request_priority(request)
+        if priority is None:
+            return JSONResponse({'error': 'فئة أولوية غير معروفة'}, status_code=400)
+
+        # قراءة الصورة بدون حجز الخيط
+        content = await file.read()
+        return JSONResponse(await _run_admitted(priority, _describe_bytes, content, file.filename))
+
+    except Overloaded as e:
+        return _overloaded_response(e)
+
+    except Exception as e:
+        return JSONResponse({'error': f'خطأ في معالجة الصورة: {str(e)}'}, status_code=500)
+
+
+async def describe_image_url(request):
+    """API لوصف الصورة من رابط URL"""
+    try:
+        try:
+            data = await request.json()
+        except ValueError:
+            data = None
+        if not data or 'url' not in data:
+            return JSONResponse({'error': 'لم يتم إرسال رابط URL'}, status_code=400)
+
+        priority = _request_priority(request)
+        if priority is None:
+            return JSONResponse({'error': 'فئة أولوية غير معروفة'}, status_code=400)
+
+        # تحميل الصورة من الرابط بشكل غير متزامن
+        response = await http_client.get(data['url'])
+        response.raise_for_status()
+
+        return JSONResponse(await _run_admitted(priority, _describe_bytes, response.content, data['url']))
+
+    except Overloaded as e:
+        return _overloaded_response(e)
+
+    except Exception as e:
+        return JSONResponse({'error': f'خطأ في معالجة الصورة: {str(e)}'}, status_code=500)
+
+
+async def similar_images(request):
+    """API للبحث عن صور مشابهة في فهرس التضمينات"""
+    try:
+        if embedding_index is None or not model_ready():
+            return JSONResponse({'error': 'فهرس التشابه غير مفعّل'}, status_code=503)
+
+        form = await request.form()
+        k = parse_k(form.get('k', 5))
+        if k is None:
+            return JSONResponse({'error': 'قيمة k غير صالحة'}, status_code=400)
+
+        priority = _request_priority(request)
+        if priority is None:
+            return JSONResponse({'error': 'فئة أولوية غير معروفة'}, status_code=400)
+
+        file = form.get('image')
+        if file is None or isinstance(file, str):
+            return JSONResponse({'error': 'لم يتم إرسال صورة'}, status_code=400)
+        if file.filename == '':
+            return JSONResponse({'error': 'لم يتم اختيار ملف'}, status_code=400)
+
+        content = await file.read()
+        return JSONResponse(await _run_admitted(priority, _similar_bytes, content, k))
+
+    except Overloaded as e:
+        return _overloaded_response(e)
+
+    except Exception as e:
+        return JSONResponse({'error': f'خطأ في البحث عن صور مشابهة: {str(e)}'}, status_code=500)
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    """إنشاء عميل HTTP مشترك لتحميل الروابط وإغلاقه مع المنفذ عند الإيقاف"""
+    global http_client
+    http_client = httpx.AsyncClient(
+        timeout=FETCH_TIMEOUT_SECONDS,
+        follow_redirects=True,
+        limits=httpx.Limits(max_connections=MAX_FETCH_CONNECTIONS),
+    )
+    try:
+        yield
+    finally:
+        await http_client.aclose()
+        inference_executor.shutdown(wait=False)
+
+
+app = Starlette(
+    routes=[
+        Route('/api/describe', describe_image, methods=['POST']),
+        Route('/api/describe_url', describe_image_url, methods=['POST']),
+        Route('/api/similar', similar_images, methods=['POST']),
+    ],
+    middleware=[Middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*'])],
+    lifespan=lifespan,
+)
@@ -0,0 +1,129 @@
+# مقارنة مسار Flask الحالي بوضع ASGI تحت اتصالات بطيئة متزامنة
+#
+# يشغّل هذا السكربت خادم صور محلياً بطيئاً عمداً، ثم يرسل طلبات /api/describe_url
+# متزامنة إلى كل خادم ويقيس الإنتاجية وزمن الاستجابة.
+#
+# التحكم في القبول (admission.py) يرفض بـ 503 كل طلب سيتجاوز هدف زمن فئته، فتحت هذا الحمل
+# يُرفض معظم الطلبات التفاعلية وتقيس المقارنة الرفض لا تحميل الروابط. لقياس تزامن الإدخال والإخراج
+# تُرسل الطلبات بأولوية batch مع هدف زمن واسع للخادمين، وتُعرض الطلبات المرفوضة منفصلة عن الأخطاء.
+#
+# مثال:
+#   export SLO_BATCH_MS=600000 INFERENCE_CONCURRENCY=2
+#   gunicorn -w 4 --threads 8 -b 127.0.0.1:5000 app:app
+#   uvicorn asgi_app:app --host 127.0.0.1 --port 8000
+#   python benchmark_serving.py --target flask=http://127.0.0.1:5000 \
+#       --target asgi=http://127.0.0.1:8000 --concurrency 1000 --delay 5 --priority batch
+#
+# (مع عامل الاستدلال المنفصل تُضبط SLO_BATCH_MS و INFERENCE_CONCURRENCY في بيئة العامل.)
+
+import argparse
+import asyncio
+import statistics
+import time
+
+import httpx
+
+DEFAULT_IMAGE = (
+    'a-candid-portrait-photograph-of-a-man-st_KpVVGsn8QOSnd0kyLfoWow_l2pg7ozMSyiSkl5HRe9eIw.jpeg'
+)
+
+
+async def start_slow_image_server(image_bytes, delay, port):
+    """خادم HTTP بسيط ينتظر delay ثانية قبل إرسال الصورة (يحاكي مضيفاً بطيئاً)"""
+    header = (
+        'HTTP/1.1 200 OK\r\n'
+        'Content-Type: image/jpeg\r\n'
+        f'Content-Length: {len(image_bytes)}\r\n'
+        'Connection: close\r\n\r\n'
+    ).encode()
+
+    async def handle(reader, writer):
+        try:
+            await reader.readuntil(b'\r\n\r\n')
+            await asyncio.sleep(delay)
+            writer.write(header + image_bytes)
+            await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, '127.0.0.1', port, backlog=4096)
+
+
+async def run_target(name, base_url, image_url, total, concurrency, timeout, priority):
+    """إرسال total طلباً بحد أقصى concurrency طلباً متزامناً"""
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = rejected = degraded = 0
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    headers = {'X-Priority': priority}
+
+    async with httpx.AsyncClient(timeout=timeout, limits=limits, headers=headers) as client:
+        async def one():
+            nonlocal errors, rejected, degraded
+            async with semaphore:
+                start = time.perf_counter()
+                try:
+                    response = await client.post(
+                        f'{base_url}/api/describe_url', json={'url': image_url}
+                    )
+                except httpx.HTTPError:
+                    errors += 1
+                    return
+                if response.status_code == 503:
+                    # رفض مبكر من التحكم في القبول، لا خطأ في الخادم
+                    rejected += 1
+                    return
+                if response.status_code != 200:
+                    errors += 1
+                    return
+                latencies.append(time.perf_counter() - start)
+                if response.json().get('degraded'):
+                    degraded += 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one() for _ in range(total)))
+        elapsed = time.perf_counter() - start
+
+    print(f"[{name}] {base_url}")
+    print(f"  طلبات ناجحة: {len(latencies)}/{total} (منها مخففة: {degraded})  "
+          f"مرفوضة (503): {rejected}  أخطاء أخرى: {errors}")
+    if rejected:
+        print("  تنبيه: الإنتاجية تشمل الطلبات المقبولة فقط؛ استخدم --priority batch مع SLO_BATCH_MS واسع")
+    print(f"  الإنتاجية: {len(latencies) / elapsed:.2f} طلب/ثانية  المدة: {elapsed:.1f} ث")
+    if latencies:
+        latencies.sort()
+        p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+        print(f"  زمن الاستجابة: الوسيط {statistics.median(latencies):.2f} ث  p95 {p95:.2f} ث")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description='مقارنة خوادم وصف الصور تحت اتصالات بطيئة')
+    parser.add_argument('--target', action='append', required=True,
+                        help='name=http://host:port (يمكن تكراره)')
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=1000)
+    parser.add_argument('--delay', type=float, default=5.0, help='تأخير مضيف الصور بالثواني')
+    parser.add_argument('--image', default=DEFAULT_IMAGE)
+    parser.add_argument('--image-port', type=int, default=8765)
+    parser.add_argument('--timeout', type=float, default=300.0)
+    parser.add_argument('--priority', choices=['interactive', 'batch'], default='interactive',
+                        help='قيمة الترويسة X-Priority (batch مع SLO_BATCH_MS واسع لقياس التزامن دون رفض)')
+    args = parser.parse_args()
+
+    with open(args.image, 'rb') as f:
+        image_bytes = f.read()
+
+    server = await start_slow_image_server(image_bytes, args.delay, args.image_port)
+    image_url = f'http://127.0.0.1:{args.image_port}/image.jpeg'
+
+    async with server:
+        for target in args.target:
+            name, _, base_url = target.partition('=')
+            await run_target(name, base_url.rstrip('/'), image_url,
+                             args.requests, args.concurrency, args.timeout, args.priority)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,316 @@
+# وصف مجموعات ضخمة من الصور دون اتصال، مع إمكانية الاستئناف
+#
+# أمثلة:
+#   python bulk_caption.py --input /data/archive --output /data/captions
+#   python bulk_caption.py --manifest images.txt --output /data/captions --format parquet
+#
+# - تُقرأ الصور وتُعالج في مجموعة عمليات (process pool)، ويُشغّل النموذج على دفعات في العملية الرئيسية.
+# - تُكتب النتائج في ملفات أجزاء (part-000000.jsonl أو .parquet) لكل مجموعة من الصور،
+#   ويُكتب كل جزء ذرياً، فوجود الجزء يعني اكتماله.
+# - تُلحق صفوف كل دفعة مكتملة بملف part-000000.partial.jsonl للجزء الجاري، فعدد أسطره
+#   الكاملة هو عدد الصور المعتمدة، وعند اكتمال الجزء يُكتب ملفه النهائي ويُحذف الملف الجزئي.
+# - تُحفظ قائمة الصور المرتبة في _manifest.txt عند أول تشغيل، فيستأنف التشغيل المقطوع
+#   من أول دفعة غير معتمدة دون إعادة معالجة أي صورة (مع نفس حجم الجزء والتنسيق واللغات المحفوظة في _config.json).
+# - إذا فشلت معالجة دفعة أو توليد أوصافها تُعاد المحاولة صورة بصورة، وتُسجل الصور الفاشلة
+#   في حقل error بدلاً من إيقاف التشغيل.
+
+import argparse
+import collections
+import json
+import os
+import time
+from multiprocessing import Pool
+
+import numpy as np
+from PIL import Image
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.webp', '.bmp', '.gif', '.tif', '.tiff'}
+MANIFEST_FILE = '_manifest.txt'
+CONFIG_FILE = '_config.json'
+
+_processor = None
+
+
+def _init_worker():
+    """تحميل المعالج مرة واحدة في كل عملية"""
+    global _processor
+    from captioning import load_image_processor
+    _processor = load_image_processor()
+
+
+def _preprocess_batch(paths):
+    """فتح دفعة صور وتحويلها إلى pixel_values داخل عملية فرعية"""
+    from captioning import preprocess_images
+
+    images, loaded, errors = [], [], {}
+    for position, path in enumerate(paths):
+        try:
+            with Image.open(path) as image:
+                images.append(image.convert('RGB'))
+            loaded.append(position)
+        except Exception as e:
+            errors[position] = str(e)
+
+    try:
+        pixel_values = preprocess_images(_processor, images) if images else None
+    except Exception:
+        # صورة واحدة غير قابلة للمعالجة (مثل صورة 1×1) تُفشل الدفعة كلها، فتُعاد صورة بصورة
+        kept, arrays = [], []
+        for position, image in zip(loaded, images):
+            try:
+                arrays.append(preprocess_images(_processor, [image]))
+                kept.append(position)
+            except Exception as e:
+                errors[position] = str(e)
+        loaded = kept
+        pixel_values = np.concatenate(arrays) if arrays else None
+    return loaded, pixel_values, errors
+
+
+def _generate_batch(processor, model, pixel_values, language):
+    """أوصاف الدفعة بلغة واحدة كقائمة (وصف، خطأ)، مع إعادة المحاولة صورة بصورة عند الفشل"""
+    from captioning import generate_descriptions
+
+    try:
+        return [(d, None) for d in generate_descriptions(processor, model, pixel_values, language)]
+    except Exception as e:
+        if len(pixel_values) == 1:
+            return [(None, str(e))]
+
+    results = []
+    for i in range(len(pixel_values)):
+        try:
+            results.append((generate_descriptions(processor, model, pixel_values[i:i + 1], language)[0], None))
+        except Exception as e:
+            results.append((None, str(e)))
+    return results
+
+
+def _collect_paths(args):
+    """قائمة الصور من مجلد أو من ملف (سطر لكل مسار)"""
+    if args.manifest:
+        with open(args.manifest, encoding='utf-8') as f:
+            return [line.strip() for line in f if line.strip()]
+
+    paths = []
+    for root, _, files in os.walk(args.input):
+        for name in files:
+            if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS:
+                paths.append(os.path.join(root, name))
+    return sorted(paths)
+
+
+def _load_manifest(args):
+    """تثبيت ترتيب الصور عند أول تشغيل لضمان استئناف صحيح"""
+    manifest_path = os.path.join(args.output, MANIFEST_FILE)
+    if os.path.exists(manifest_path):
+        with open(manifest_path, encoding='utf-8') as f:
+            return [line.rstrip('\n') for line in f]
+
+    paths = _collect_paths(args)
+    with open(manifest_path + '.tmp', 'w', encoding='utf-8') as f:
+        f.writelines(path + '\n' for path in paths)
+    os.replace(manifest_path + '.tmp', manifest_path)
+    return paths
+
+
+# إعدادات التشغيل الأول (مع قيمها الافتراضية) التي يجب أن يستأنف بها أي تشغيل لاحق
+RESUME_SETTINGS = {
+    'chunk_size': 1024,
+    'format': 'jsonl',
+    'languages': ['english', 'arabic'],
+}
+
+
+def _load_config(args):
+    """استخدام حجم الجزء والتنسيق واللغات من التشغيل الأول حتى تتطابق الأجزاء وحقولها"""
+    config_path = os.path.join(args.output, CONFIG_FILE)
+    config = {}
+    if os.path.exists(config_path):
+        with open(config_path) as f:
+            config = json.load(f)
+    for name, default in RESUME_SETTINGS.items():
+        value = getattr(args, name)
+        if name in config:
+            if value is not None and value != config[name]:
+                print(f"تجاهل --{name.replace('_', '-')}={value}: "
+                      f"يُستأنف التشغيل بالقيمة المحفوظة {config[name]}")
+            value = config[name]
+        setattr(args, name, default if value is None else value)
+
+    if any(name not in config for name in RESUME_SETTINGS):
+        with open(config_path + '.tmp', 'w') as f:
+            json.dump({name: getattr(args, name) for name in RESUME_SETTINGS}, f)
+        os.replace(config_path + '.tmp', config_path)
+
+
+def _part_path(args, chunk_id):
+    return os.path.join(args.output, f'part-{chunk_id:06d}.{args.format}')
+
+
+def _partial_path(args, chunk_id):
+    return os.path.join(args.output, f'part-{chunk_id:06d}.partial.jsonl')
+
+
+def _load_partial(args, chunk_id):
+    """الصفوف المعتمدة لجزء غير مكتمل، مع حذف أي سطر أخير لم تكتمل كتابته"""
+    path = _partial_path(args, chunk_id)
+    if not os.path.exists(path):
+        return []
+    rows, size = [], 0
+    with open(path, 'rb') as f:
+        for line in f:
+            if not line.endswith(b'\n'):
+                break
+            try:
+                rows.append(json.loads(line))
+            except ValueError:
+                break
+            size += len(line)
+    with open(path, 'r+b') as f:
+        f.truncate(size)
+    return rows
+
+
+def _append_partial(args, chunk_id, rows):
+    """اعتماد صفوف دفعة مكتملة على القرص"""
+    with open(_partial_path(args, chunk_id), 'a', encoding='utf-8') as f:
+        f.write(''.join(json.dumps(row, ensure_ascii=False) + '\n' for row in rows))
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _finish_part(args, chunk_id):
+    """كتابة الجزء النهائي من صفوفه المعتمدة ثم حذف الملف الجزئي"""
+    _write_part(args, chunk_id, _load_partial(args, chunk_id))
+    os.remove(_partial_path(args, chunk_id))
+
+
+def _write_part(args, chunk_id, rows):
+    """كتابة جزء كامل في ملف مؤقت ثم نقله ذرياً"""
+    path = _part_path(args, chunk_id)
+    tmp_path = path + '.tmp'
+    if args.format == 'parquet':
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        # مخطط صريح حتى لا يُستنتج حقل error كنوع null في الأجزاء الخالية من الأخطاء
+        schema = pa.schema([(name, pa.string()) for name in ['path', 'error'] + args.languages])
+        pq.write_table(pa.Table.from_pylist(rows, schema=schema), tmp_path)
+    else:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for row in rows:
+                f.write(json.dumps(row, ensure_ascii=False) + '\n')
+    os.replace(tmp_path, path)
+
+
+def _chunk(paths, chunk_id, args):
+    return paths[chunk_id * args.chunk_size:(chunk_id + 1) * args.chunk_size]
+
+
+def _batches(paths, chunk_ids, committed, args):
+    """تقسيم الصور غير المعتمدة إلى دفعات: (رقم الجزء، المسارات، هل هي آخر دفعة في الجزء)"""
+    for chunk_id in chunk_ids:
+        chunk = _chunk(paths, chunk_id, args)
+        for start in range(committed.get(chunk_id, 0), len(chunk), args.batch_size):
+            yield chunk_id, chunk[start:start + args.batch_size], start + args.batch_size >= len(chunk)
+
+
+def main():
+    cpu_count = os.cpu_count() or 1
+    parser = argparse.ArgumentParser(description='وصف مجموعات ضخمة من الصور دون اتصال')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--input', help='مجلد الصور (يُفحص بشكل متكرر)')
+    source.add_argument('--manifest', help='ملف يحتوي مساراً لكل سطر')
+    parser.add_argument('--output', required=True, help='مجلد النتائج ونقطة الاستئناف')
+    # القيم الافتراضية لهذه الخيارات في RESUME_SETTINGS، فالتشغيل المستأنف يأخذها من _config.json
+    parser.add_argument('--format', choices=['jsonl', 'parquet'], help='افتراضياً jsonl')
+    parser.add_argument('--languages', nargs='+', choices=['english', 'arabic'],
+                        help='افتراضياً english arabic')
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--chunk-size', type=int,
+                        help='عدد الصور في كل ملف جزء، افتراضياً 1024 (الاستئناف يتم من آخر دفعة معتمدة)')
+    parser.add_argument('--workers', type=int, default=max(1, cpu_count // 4),
+                        help='عمليات قراءة ومعالجة الصور')
+    parser.add_argument('--threads', type=int, default=None,
+                        help='خيوط torch للاستدلال (افتراضياً بقية الأنوية)')
+    args = parser.parse_args()
+
+    os.makedirs(args.output, exist_ok=True)
+    _load_config(args)
+    if args.format == 'parquet':
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            raise SystemExit("يتطلب تنسيق parquet تثبيت pyarrow")
+    paths = _load_manifest(args)
+    chunk_count = (len(paths) + args.chunk_size - 1) // args.chunk_size
+    pending = [c for c in range(chunk_count) if not os.path.exists(_part_path(args, c))]
+    committed = {c: len(_load_partial(args, c)) for c in pending}
+    # جزء اعتُمدت كل دفعاته وانقطع التشغيل قبل كتابة ملفه النهائي
+    for chunk_id in [c for c in pending if committed[c] == len(_chunk(paths, c, args))]:
+        _finish_part(args, chunk_id)
+        pending.remove(chunk_id)
+    remaining = sum(len(_chunk(paths, c, args)) - committed[c] for c in pending)
+    print(f"الصور: {len(paths)}  الأجزاء المتبقية: {len(pending)}/{chunk_count}  ({remaining} صورة)")
+    if not pending:
+        return
+
+    # إنشاء العمليات قبل تحميل النموذج حتى لا تُنسخ أوزانه إليها
+    pool = Pool(args.workers, initializer=_init_worker)
+
+    import torch
+    from captioning import load_image_captioning_model
+    torch.set_num_threads(args.threads or max(1, cpu_count - args.workers))
+    processor, model = load_image_captioning_model()
+    if processor is None or model is None:
+        raise SystemExit("Model not loaded")
+
+    started = time.perf_counter()
+    done = 0
+    # عدد محدود من الدفعات قيد المعالجة لتبقى الذاكرة ثابتة مهما كان حجم الأرشيف
+    in_flight = collections.deque()
+    batches = _batches(paths, pending, committed, args)
+
+    with pool:
+        while True:
+            while len(in_flight) < args.workers * 2:
+                try:
+                    chunk_id, batch, last = next(batches)
+                except StopIteration:
+                    break
+                in_flight.append((chunk_id, batch, last, pool.apply_async(_preprocess_batch, (batch,))))
+            if not in_flight:
+                break
+
+            chunk_id, batch, last, pending_result = in_flight.popleft()
+            loaded, pixel_values, errors = pending_result.get()
+
+            # نفس الحقول في كل صف ليبقى مخطط parquet ثابتاً
+            batch_rows = [
+                dict({'path': path, 'error': None}, **{language: None for language in args.languages})
+                for path in batch
+            ]
+            for position, error in errors.items():
+                batch_rows[position]['error'] = error
+            if pixel_values is not None:
+                for language in args.languages:
+                    results = _generate_batch(processor, model, pixel_values, language)
+                    for position, (description, error) in zip(loaded, results):
+                        batch_rows[position][language] = description
+                        if error is not None and batch_rows[position]['error'] is None:
+                            batch_rows[position]['error'] = f'{language}: {error}'
+            _append_partial(args, chunk_id, batch_rows)
+
+            done += len(batch)
+            if last:
+                _finish_part(args, chunk_id)
+                elapsed = time.perf_counter() - started
+                print(f"[{chunk_id + 1}/{chunk_count}] {done}/{remaining} صورة  "
+                      f"{done / elapsed:.2f} صورة/ثانية")
+
+    elapsed = time.perf_counter() - started
+    print(f"اكتمل: {done} صورة في {elapsed:.1f} ث ({done / elapsed:.2f} صورة/ثانية)")
+
+
+if __name__ == '__main__':
+    main()
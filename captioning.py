@@ -0,0 +1,193 @@
+# منطق النموذج المشترك بين خادم Flask وعامل الاستدلال المنفصل
+
+import os
+
+import numpy as np
+import torch
+from dotenv import load_dotenv
+from transformers import AutoProcessor, AutoModelForVision2Seq
+
+# تحميل المتغيرات البيئية
+load_dotenv()
+
+# استخدام نموذج متعدد اللغات لوصف الصور
+MODEL_NAME = os.getenv('MODEL_NAME', 'microsoft/git-base-coco')
+
+# لقطة جاهزة (model_snapshot.py) تُحمّل بدلاً من from_pretrained لتسريع بدء التشغيل
+MODEL_SNAPSHOT = os.getenv('MODEL_SNAPSHOT')
+
+# إعدادات التوليد لكل لغة
+GENERATION_SETTINGS = {
+    'english': {
+        'max_length': 50,
+        'num_beams': 4,
+        'early_stopping': True,
+    },
+    'arabic': {
+        'max_length': 50,
+        'num_beams': 4,
+        'early_stopping': True,
+        'do_sample': True,
+        'temperature': 0.7,
+    },
+}
+
+# إعدادات أرخص (بحث جشع ووصف أقصر) تُستخدم عند الضغط بدلاً من رفض الطلب
+FAST_GENERATION_SETTINGS = {
+    'english': {
+        'max_length': 30,
+        'num_beams': 1,
+    },
+    'arabic': {
+        'max_length': 30,
+        'num_beams': 1,
+    },
+}
+
+# ترجمة بسيطة للكلمات الأساسية (يمكن تحسينها)
+ARABIC_TRANSLATIONS = {
+    "a person": "شخص",
+    "a man": "رجل",
+    "a woman": "امرأة",
+    "a child": "طفل",
+    "a dog": "كلب",
+    "a cat": "قط",
+    "a car": "سيارة",
+    "a building": "مبنى",
+    "a tree": "شجرة",
+    "a flower": "زهرة",
+    "a table": "طاولة",
+    "a chair": "كرسي",
+    "a book": "كتاب",
+    "a phone": "هاتف",
+    "a computer": "حاسوب",
+    "a camera": "كاميرا",
+    "a street": "شارع",
+    "a road": "طريق",
+    "a mountain": "جبل",
+    "a sea": "بحر",
+    "a river": "نهر",
+    "a sky": "سماء",
+    "a sun": "شمس",
+    "a moon": "قمر",
+    "a star": "نجمة",
+    "a cloud": "سحابة",
+    "a rain": "مطر",
+    "a snow": "ثلج",
+    "a fire": "نار",
+    "a water": "ماء",
+    "a food": "طعام",
+    "a drink": "شراب",
+    "a shirt": "قميص",
+    "a pants": "بنطلون",
+    "a hat": "قبعة",
+    "a shoe": "حذاء",
+    "a bag": "حقيبة",
+    "a clock": "ساعة",
+    "a door": "باب",
+    "a window": "نافذة",
+    "a wall": "جدار",
+    "a floor": "أرضية",
+    "a ceiling": "سقف",
+    "a light": "ضوء",
+    "a shadow": "ظل",
+    "a color": "لون",
+    "a red": "أحمر",
+    "a blue": "أزرق",
+    "a green": "أخضر",
+    "a yellow": "أصفر",
+    "a black": "أسود",
+    "a white": "أبيض",
+    "a big": "كبير",
+    "a small": "صغير",
+    "a tall": "طويل",
+    "a short": "قصير",
+    "a beautiful": "جميل",
+    "a nice": "جميل",
+    "a good": "جيد",
+    "a bad": "سيء",
+    "a happy": "سعيد",
+    "a sad": "حزين",
+    "a young": "شاب",
+    "a old": "عجوز",
+    "a new": "جديد",
+    "a old": "قديم"
+}
+
+
+def load_image_captioning_model():
+    """تحميل نموذج وصف الصور"""
+    if MODEL_SNAPSHOT:
+        try:
+            from model_snapshot import load_snapshot
+            return load_snapshot(MODEL_SNAPSHOT)
+        except Exception as e:
+            print(f"خطأ في تحميل اللقطة، سيتم استخدام from_pretrained: {e}")
+
+    try:
+        processor = AutoProcessor.from_pretrained(MODEL_NAME)
+        model = AutoModelForVision2Seq.from_pretrained(MODEL_NAME)
+        model.eval()
+        return processor, model
+    except Exception as e:
+        print(f"خطأ في تحميل النموذج: {e}")
+        return None, None
+
+
+def load_image_processor():
+    """تحميل المعالج فقط (بدون أوزان النموذج) لخوادم الواجهة"""
+    if MODEL_SNAPSHOT:
+        try:
+            from model_snapshot import load_snapshot_processor
+            return load_snapshot_processor(MODEL_SNAPSHOT)
+        except Exception as e:
+            print(f"خطأ في تحميل معالج اللقطة، سيتم استخدام from_pretrained: {e}")
+
+    try:
+        return AutoProcessor.from_pretrained(MODEL_NAME)
+    except Exception as e:
+        print(f"خطأ في تحميل المعالج: {e}")
+        return None
+
+
+def preprocess_images(processor, images):
+    """تحويل الصور إلى مصفوفة pixel_values متصلة في الذاكرة"""
+    inputs = processor(images=images, return_tensors="np")
+    return np.ascontiguousarray(inputs.pixel_values, dtype=np.float32)
+
+
+def translate_to_arabic(description):
+    """تطبيق الترجمات على الوصف الإنجليزي"""
+    arabic_description = description
+    for english, arabic in ARABIC_TRANSLATIONS.items():
+        arabic_description = arabic_description.replace(english, arabic)
+    return arabic_description.strip()
+
+
+def generate_descriptions(processor, model, pixel_values, language, fast=False):
+    """توليد أوصاف دفعة من الصور بلغة واحدة"""
+    if not isinstance(pixel_values, torch.Tensor):
+        pixel_values = torch.from_numpy(pixel_values)
+
+    with torch.no_grad():
+        generated_ids = model.generate(
+            pixel_values=pixel_values,
+            **(FAST_GENERATION_SETTINGS if fast else GENERATION_SETTINGS)[language]
+        )
+
+    # تحويل المعرفات إلى نص
+    descriptions = processor.batch_decode(generated_ids, skip_special_tokens=True)
+    if language == 'arabic':
+        return [translate_to_arabic(d) for d in descriptions]
+    return [d.strip() for d in descriptions]
+
+
+def compute_embeddings(model, pixel_values):
+    """تجميع مخرجات مشفر الرؤية في GIT إلى متجه مطبّع لكل صورة"""
+    if not isinstance(pixel_values, torch.Tensor):
+        pixel_values = torch.from_numpy(pixel_values)
+
+    with torch.no_grad():
+        hidden_states = model.git.image_encoder(pixel_values).last_hidden_state
+        embeddings = torch.nn.functional.normalize(hidden_states.mean(dim=1), dim=-1)
+    return embeddings.numpy().astype(np.float32)
@@ -0,0 +1,153 @@
+# منطق الوصف والبحث المشترك بين خادم Flask (app.py) ووضع ASGI (asgi_app.py)
+#
+# يحمل النموذج محلياً أو يتصل بعامل الاستدلال المنفصل، ويدير فهرس التضمينات الاختياري،
+# دون أي اعتماد على إطار الويب.
+
+import os
+import time
+
+from dotenv import load_dotenv
+
+from admission import Overloaded
+from captioning import (
+    load_image_captioning_model,
+    load_image_processor,
+    preprocess_images,
+    generate_descriptions,
+    compute_embeddings,
+)
+from embedding_index import EmbeddingIndex
+from inference_server import EMBEDDING, InferenceClient
+
+# تحميل المتغيرات البيئية
+load_dotenv()
+
+# عند ضبط INFERENCE_SOCKET يتولى عامل الاستدلال المنفصل النموذج والتجميع،
+# ويكتفي خادم الواجهة بالمعالج لتحويل الصور إلى pixel_values
+INFERENCE_SOCKET = os.getenv('INFERENCE_SOCKET')
+
+if INFERENCE_SOCKET:
+    processor, model = load_image_processor(), None
+    inference_client = InferenceClient(INFERENCE_SOCKET)
+else:
+    # تحميل النموذج عند بدء التطبيق
+    processor, model = load_image_captioning_model()
+    inference_client = None
+
+# فهرس التضمينات (اختياري) لبحث التشابه وإعادة استخدام أوصاف الصور المتطابقة تقريباً
+EMBEDDING_INDEX_DIR = os.getenv('EMBEDDING_INDEX_DIR')
+CAPTION_REUSE_THRESHOLD = float(os.getenv('CAPTION_REUSE_THRESHOLD', '0.97'))
+# حد أقصى للمتجهات الممسوحة بشكل مسطّح في مسار الطلب؛ بعده تتوقف إعادة الاستخدام والفهرسة
+# (وتمريرة مشفر الرؤية الإضافية) حتى يُعاد بناء فهرس IVF-PQ
+REUSE_MAX_FLAT_ROWS = int(os.getenv('REUSE_MAX_FLAT_ROWS', '100000'))
+embedding_index = EmbeddingIndex(EMBEDDING_INDEX_DIR) if EMBEDDING_INDEX_DIR else None
+
+
+def model_ready():
+    """التحقق من توفر النموذج محلياً أو عبر عامل الاستدلال"""
+    return processor is not None and (model is not None or inference_client is not None)
+
+
+def _generate(pixel_values, languages, ticket=None):
+    """توليد الأوصاف المطلوبة لصورة واحدة بنمط توليد التذكرة (يقرره العامل المنفصل إن وُجد)"""
+    fast = ticket is not None and ticket.fast
+    if inference_client is not None:
+        result = inference_client.describe(pixel_values, languages, fast, ticket)
+        return {language: result[language][0] for language in languages}
+    return {
+        language: generate_descriptions(processor, model, pixel_values, language, fast)[0]
+        for language in languages
+    }
+
+
+def _embed(pixel_values, ticket=None):
+    """حساب تضمين الصورة من مشفر الرؤية"""
+    if inference_client is not None:
+        return inference_client.describe(pixel_values, [EMBEDDING], ticket=ticket)[EMBEDDING][0]
+    return compute_embeddings(model, pixel_values)[0]
+
+
+def describe_image_english(image):
+    """وصف الصورة باللغة الإنجليزية"""
+    try:
+        if not model_ready():
+            return "Model not loaded"
+        return _generate(preprocess_images(processor, image), ['english'])['english']
+    except Exception as e:
+        return f"Error generating English description: {str(e)}"
+
+
+def describe_image_arabic(image):
+    """وصف الصورة باللغة العربية"""
+    try:
+        if not model_ready():
+            return "النموذج غير محمل"
+        return _generate(preprocess_images(processor, image), ['arabic'])['arabic']
+    except Exception as e:
+        return f"خطأ في توليد الوصف العربي: {str(e)}"
+
+
+def describe_image_bilingual(image, ticket=None, source=None):
+    """وصف الصورة باللغتين بمعالجة واحدة للصورة، بنمط توليد تذكرة القبول مع تسجيل زمن generate فيها
+
+    يُحفظ source (اسم الملف المرفوع أو الرابط) مع الوصف في فهرس التضمينات.
+    """
+    if not model_ready():
+        return describe_image_english(image), describe_image_arabic(image)
+    try:
+        pixel_values = preprocess_images(processor, image)
+        embedding = None
+        if embedding_index is not None and embedding_index.flat_rows() <= REUSE_MAX_FLAT_ROWS:
+            # إعادة استخدام وصف صورة شبه مطابقة بدلاً من تشغيل generate
+            embedding = _embed(pixel_values)
+            matches = embedding_index.search(embedding, k=1)
+            if matches and matches[0][1] >= CAPTION_REUSE_THRESHOLD:
+                record = embedding_index.record(matches[0][0])
+                return record['english'], record['arabic']
+        started = time.monotonic()
+        result = _generate(pixel_values, ['english', 'arabic'], ticket)
+        # يُسجل زمن التوليد الناجح فقط، لا إعادة الاستخدام ولا الأخطاء
+        if ticket is not None:
+            ticket.service_time = time.monotonic() - started
+    except Overloaded:
+        # رفض عامل الاستدلال الطلب؛ يُعاد إلى المسار ليرد بـ 503
+        raise
+    except Exception:
+        return describe_image_english(image), describe_image_arabic(image)
+
+    # لا تُفهرس الأوصاف المخففة حتى لا يُعاد استخدامها بدل الأوصاف الكاملة
+    if embedding is not None and not (ticket is not None and ticket.fast):
+        try:
+            embedding_index.add(embedding, dict(
+                result,
+                source=source,
+                indexed_at=time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+            ))
+        except Exception as e:
+            print(f"خطأ في إضافة الصورة إلى الفهرس: {e}")
+    return result['english'], result['arabic']
+
+
+def find_similar_images(image, k=5, ticket=None):
+    """أقرب k صورة مفهرسة مع أوصافها ومصدرها ودرجة التشابه"""
+    embedding = _embed(preprocess_images(processor, image), ticket)
+    similar = []
+    for row, score in embedding_index.search(embedding, k=k):
+        record = embedding_index.record(row)
+        similar.append({
+            'id': row,
+            'score': score,
+            'english': record.get('english'),
+            'arabic': record.get('arabic'),
+            'source': record.get('source'),
+            'indexed_at': record.get('indexed_at')
+        })
+    return similar
+
+
+def parse_k(value):
+    """عدد النتائج المطلوبة محصوراً بين 1 و 100، أو None إذا لم يكن عدداً صحيحاً"""
+    try:
+        return min(max(int(value), 1), 100)
+    except (TypeError, ValueError):
+        return None
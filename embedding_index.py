@@ -0,0 +1,355 @@
+# فهرس متجهات على القرص لتضمينات الصور: بحث التشابه وإعادة استخدام الأوصاف
+#
+# هيكل المجلد:
+#   meta.json       البعد
+#   vectors.f32     المتجهات المطبّعة (float32) متتالية، تُقرأ عبر memmap
+#   offsets.i64     موضع كل سجل داخل records.jsonl
+#   records.jsonl   الأوصاف ومصدر الصورة ووقت الإضافة لكل متجه
+#   ivfpq.json      (اختياري) يشير إلى آخر فهرس IVF-PQ مكتمل
+#   ivfpq-<رقم>/    فهرس IVF مع تكميم المنتج (PQ) يُبنى دون اتصال
+#
+# البحث المسطّح يمر على المتجهات على دفعات بعمليات NumPy متجهة. عند بناء فهرس IVF-PQ
+# يُبحث فقط في أقرب nprobe قائمة ثم يُعاد ترتيب المرشحين بالمسافة الدقيقة، والمتجهات
+# المضافة بعد البناء تُفحص بشكل مسطّح حتى إعادة البناء التالية، لذا يجب إعادة تشغيل
+# أمر البناء دورياً (مثلاً عبر cron) حتى لا يكبر الجزء المسطّح مع نمو الفهرس.
+#
+# بناء فهرس IVF-PQ:
+#   python embedding_index.py build /path/to/index --nlist 1024 --m 64
+
+import argparse
+import fcntl
+import json
+import os
+import shutil
+import threading
+import time
+
+import numpy as np
+
+SEARCH_CHUNK_ROWS = 65536
+PQ_CENTROIDS = 256
+
+
+def _normalize(vectors):
+    """تطبيع المتجهات لتصبح المسافة الإقليدية مكافئة للتشابه الجيبي"""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def _nearest(data, centroids, centroid_norms=None):
+    """أقرب مركز لكل صف (بالمسافة الإقليدية المربعة)"""
+    if centroid_norms is None:
+        centroid_norms = (centroids ** 2).sum(axis=1)
+    labels = np.empty(len(data), dtype=np.int64)
+    for start in range(0, len(data), SEARCH_CHUNK_ROWS):
+        chunk = np.asarray(data[start:start + SEARCH_CHUNK_ROWS], dtype=np.float32)
+        distances = centroid_norms[None, :] - 2 * chunk @ centroids.T
+        labels[start:start + len(chunk)] = distances.argmin(axis=1)
+    return labels
+
+
+def _kmeans(data, k, iterations, rng):
+    """خوارزمية Lloyd بسيطة بـ NumPy"""
+    data = np.asarray(data, dtype=np.float32)
+    centroids = data[rng.choice(len(data), k, replace=False)].copy()
+    for _ in range(iterations):
+        labels = _nearest(data, centroids)
+        order = np.argsort(labels, kind='stable')
+        counts = np.bincount(labels, minlength=k)
+        nonempty = np.flatnonzero(counts)
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))[nonempty]
+        sums = np.add.reduceat(data[order], starts, axis=0)
+        centroids[nonempty] = sums / counts[nonempty, None]
+        # إعادة تهيئة المراكز الفارغة بنقاط عشوائية
+        empty = np.flatnonzero(counts == 0)
+        if len(empty):
+            centroids[empty] = data[rng.choice(len(data), len(empty), replace=False)]
+    return centroids
+
+
+def _top_k(ids, scores, k):
+    """أفضل k نتيجة مرتبة تنازلياً حسب التشابه"""
+    if len(scores) > k:
+        keep = np.argpartition(-scores, k - 1)[:k]
+        ids, scores = ids[keep], scores[keep]
+    order = np.argsort(-scores, kind='stable')
+    return ids[order], scores[order]
+
+
+class _IVFPQ:
+    """فهرس IVF-PQ مخزّن كملفات npy تُحمّل عبر memmap"""
+
+    def __init__(self, path):
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.count = json.load(f)['count']
+        self.centroids = np.load(os.path.join(path, 'centroids.npy'))
+        self.centroid_norms = (self.centroids ** 2).sum(axis=1)
+        self.codebooks = np.load(os.path.join(path, 'codebooks.npy'))
+        self.list_offsets = np.load(os.path.join(path, 'list_offsets.npy'))
+        self.list_ids = np.load(os.path.join(path, 'list_ids.npy'), mmap_mode='r')
+        self.codes = np.load(os.path.join(path, 'codes.npy'), mmap_mode='r')
+
+    @classmethod
+    def build(cls, path, vectors, nlist, m, sample_size, iterations, seed):
+        """تدريب المراكز وكتب الترميز على عينة ثم ترميز كل المتجهات"""
+        count, dim = vectors.shape
+        if dim % m:
+            raise ValueError(f"البعد {dim} لا يقبل القسمة على m={m}")
+        if count < max(nlist, PQ_CENTROIDS):
+            raise ValueError(f"عدد المتجهات ({count}) غير كافٍ لبناء الفهرس")
+
+        rng = np.random.default_rng(seed)
+        sample_ids = np.sort(rng.choice(count, min(sample_size, count), replace=False))
+        sample = np.asarray(vectors[sample_ids])
+
+        # المستوى الأول: تقسيم الفضاء إلى nlist قائمة
+        centroids = _kmeans(sample, nlist, iterations, rng)
+        residuals = sample - centroids[_nearest(sample, centroids)]
+
+        # المستوى الثاني: تكميم البواقي لكل فضاء جزئي إلى 256 رمزاً
+        dsub = dim // m
+        codebooks = np.stack([
+            _kmeans(residuals[:, j * dsub:(j + 1) * dsub], PQ_CENTROIDS, iterations, rng)
+            for j in range(m)
+        ])
+
+        assignments = np.empty(count, dtype=np.int64)
+        codes = np.empty((count, m), dtype=np.uint8)
+        centroid_norms = (centroids ** 2).sum(axis=1)
+        for start in range(0, count, SEARCH_CHUNK_ROWS):
+            chunk = np.asarray(vectors[start:start + SEARCH_CHUNK_ROWS])
+            labels = _nearest(chunk, centroids, centroid_norms)
+            assignments[start:start + len(chunk)] = labels
+            residual = chunk - centroids[labels]
+            for j in range(m):
+                codes[start:start + len(chunk), j] = _nearest(
+                    residual[:, j * dsub:(j + 1) * dsub], codebooks[j]
+                )
+
+        order = np.argsort(assignments, kind='stable')
+        list_offsets = np.searchsorted(assignments[order], np.arange(nlist + 1))
+
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, 'centroids.npy'), centroids)
+        np.save(os.path.join(path, 'codebooks.npy'), codebooks)
+        np.save(os.path.join(path, 'list_offsets.npy'), list_offsets)
+        np.save(os.path.join(path, 'list_ids.npy'), order)
+        np.save(os.path.join(path, 'codes.npy'), codes[order])
+        # يُكتب meta.json أخيراً ليدل على اكتمال البناء
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump({'count': int(count), 'nlist': nlist, 'm': m}, f)
+        return cls(path)
+
+    def search(self, query, nprobe, limit):
+        """مرشحو أقرب nprobe قائمة مرتبين بمسافة PQ التقريبية"""
+        distances = self.centroid_norms - 2 * self.centroids @ query
+        nprobe = min(nprobe, len(distances))
+        probe = np.argpartition(distances, nprobe - 1)[:nprobe]
+
+        m, _, dsub = self.codebooks.shape
+        subspaces = np.arange(m)[None, :]
+        candidate_ids, candidate_distances = [], []
+        for list_id in probe:
+            start, end = self.list_offsets[list_id], self.list_offsets[list_id + 1]
+            if start == end:
+                continue
+            residual = (query - self.centroids[list_id]).reshape(m, 1, dsub)
+            # جدول المسافات بين بواقي الاستعلام وكل رمز في كل فضاء جزئي
+            table = ((self.codebooks - residual) ** 2).sum(axis=2)
+            candidate_distances.append(table[subspaces, self.codes[start:end]].sum(axis=1))
+            candidate_ids.append(self.list_ids[start:end])
+
+        if not candidate_ids:
+            return np.empty(0, dtype=np.int64)
+        ids = np.concatenate(candidate_ids)
+        distances = np.concatenate(candidate_distances)
+        if len(ids) > limit:
+            ids = ids[np.argpartition(distances, limit - 1)[:limit]]
+        return ids
+
+
+class EmbeddingIndex:
+    """فهرس تضمينات الصور مع أوصافها، آمن للاستخدام من عدة خيوط وعمليات"""
+
+    def __init__(self, path, nprobe=16, rerank=256):
+        self.path = path
+        self.nprobe = nprobe
+        self.rerank = rerank
+        self.dim = None
+        self._lock = threading.Lock()
+        self._vectors = None
+        self._offsets = None
+        self._count = 0
+        self._quantized = None
+        self._quantized_version = None
+        os.makedirs(path, exist_ok=True)
+        self._load_meta()
+        self._load_quantized()
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def _load_meta(self):
+        if os.path.exists(self._file('meta.json')):
+            with open(self._file('meta.json')) as f:
+                self.dim = json.load(f)['dim']
+
+    def _load_quantized(self):
+        """تحميل آخر فهرس IVF-PQ إذا تغيّر منذ آخر تحميل"""
+        try:
+            with open(self._file('ivfpq.json')) as f:
+                name = json.load(f)['dir']
+        except FileNotFoundError:
+            return
+        if name != self._quantized_version:
+            self._quantized = _IVFPQ(self._file(name))
+            self._quantized_version = name
+
+    def _refresh(self):
+        """إعادة ربط memmap إذا أضافت عملية أخرى متجهات جديدة"""
+        if self.dim is None:
+            self._load_meta()
+            if self.dim is None:
+                return
+        vectors_path = self._file('vectors.f32')
+        size = os.path.getsize(vectors_path) if os.path.exists(vectors_path) else 0
+        count = size // (self.dim * 4)
+        if count != self._count:
+            self._vectors = np.memmap(vectors_path, dtype=np.float32, mode='r',
+                                      shape=(count, self.dim)) if count else None
+            self._offsets = np.memmap(self._file('offsets.i64'), dtype=np.int64, mode='r',
+                                      shape=(count,)) if count else None
+            self._count = count
+        self._load_quantized()
+
+    def __len__(self):
+        with self._lock:
+            self._refresh()
+            return self._count
+
+    def flat_rows(self):
+        """عدد المتجهات التي سيمر عليها البحث المسطّح (كلها، أو المضافة بعد آخر بناء)"""
+        with self._lock:
+            self._refresh()
+            if self._quantized is None:
+                return self._count
+            return self._count - self._quantized.count
+
+    def add(self, vector, record):
+        """إضافة متجه مع سجل JSON وإرجاع رقمه"""
+        vector = _normalize(vector).reshape(-1)
+        line = (json.dumps(record, ensure_ascii=False) + '\n').encode('utf-8')
+
+        with self._lock, open(self._file('.lock'), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            if self.dim is None:
+                self._load_meta()
+            if self.dim is None:
+                self.dim = len(vector)
+                # كتابة ذرية، فالقراء في العمليات الأخرى لا يأخذون القفل
+                with open(self._file('meta.json.tmp'), 'w') as f:
+                    json.dump({'dim': self.dim}, f)
+                os.replace(self._file('meta.json.tmp'), self._file('meta.json'))
+            if len(vector) != self.dim:
+                raise ValueError(f"بعد المتجه {len(vector)} لا يطابق بعد الفهرس {self.dim}")
+
+            vectors_path = self._file('vectors.f32')
+            size = os.path.getsize(vectors_path) if os.path.exists(vectors_path) else 0
+            row = size // (self.dim * 4)
+
+            with open(self._file('records.jsonl'), 'ab') as f:
+                offset = f.seek(0, os.SEEK_END)
+                f.write(line)
+            with open(self._file('offsets.i64'), 'ab') as f:
+                # تجاهل أي إزاحة يتيمة من إضافة سابقة لم تكتمل
+                f.truncate(row * 8)
+                f.write(np.int64(offset).tobytes())
+            # كتابة المتجه أخيراً تعني اعتماد السجل
+            with open(vectors_path, 'ab') as f:
+                f.write(vector.tobytes())
+            return row
+
+    def record(self, row):
+        """قراءة السجل المرتبط بمتجه"""
+        with self._lock:
+            self._refresh()
+            offset = int(self._offsets[row])
+        with open(self._file('records.jsonl'), 'rb') as f:
+            f.seek(offset)
+            return json.loads(f.readline())
+
+    def search(self, query, k=5):
+        """أقرب k متجه بالتشابه الجيبي: قائمة من (الرقم، التشابه)"""
+        with self._lock:
+            self._refresh()
+            vectors, count, quantized = self._vectors, self._count, self._quantized
+        if not count:
+            return []
+
+        query = _normalize(query).reshape(-1)
+        if quantized is not None:
+            ids = quantized.search(query, self.nprobe, max(self.rerank, k))
+            # المتجهات المضافة بعد بناء الفهرس تُفحص بشكل مسطّح
+            tail_ids, tail_scores = self._flat_search(vectors, query, k, quantized.count, count)
+            ids = np.sort(ids)
+            scores = np.asarray(vectors[ids]) @ query
+            ids = np.concatenate((ids, tail_ids))
+            scores = np.concatenate((scores, tail_scores))
+        else:
+            ids, scores = self._flat_search(vectors, query, k, 0, count)
+
+        ids, scores = _top_k(ids, scores, k)
+        return [(int(i), float(s)) for i, s in zip(ids, scores)]
+
+    @staticmethod
+    def _flat_search(vectors, query, k, start, end):
+        """بحث شامل على دفعات من memmap"""
+        best_ids = np.empty(0, dtype=np.int64)
+        best_scores = np.empty(0, dtype=np.float32)
+        for chunk_start in range(start, end, SEARCH_CHUNK_ROWS):
+            chunk_end = min(chunk_start + SEARCH_CHUNK_ROWS, end)
+            scores = np.asarray(vectors[chunk_start:chunk_end]) @ query
+            ids = np.arange(chunk_start, chunk_end)
+            best_ids, best_scores = _top_k(
+                np.concatenate((best_ids, ids)), np.concatenate((best_scores, scores)), k
+            )
+        return best_ids, best_scores
+
+    def build_quantized(self, nlist=1024, m=64, sample_size=100000, iterations=20, seed=0):
+        """بناء فهرس IVF-PQ لكل المتجهات الحالية"""
+        with self._lock:
+            self._refresh()
+            vectors = self._vectors
+        if vectors is None:
+            raise ValueError("الفهرس فارغ")
+        # البناء في مجلد جديد ثم تبديل المؤشر ذرياً، فلا تُمس ملفات تربطها عمليات أخرى
+        name = f'ivfpq-{time.time_ns()}'
+        quantized = _IVFPQ.build(self._file(name), vectors, nlist, m, sample_size, iterations, seed)
+        with open(self._file('ivfpq.json.tmp'), 'w') as f:
+            json.dump({'dir': name}, f)
+        os.replace(self._file('ivfpq.json.tmp'), self._file('ivfpq.json'))
+
+        with self._lock:
+            previous = self._quantized_version
+            self._quantized, self._quantized_version = quantized, name
+        if previous:
+            # الملفات المربوطة حالياً تبقى صالحة حتى تُغلق
+            shutil.rmtree(self._file(previous), ignore_errors=True)
+        return quantized
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='إدارة فهرس تضمينات الصور')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build = subparsers.add_parser('build', help='بناء فهرس IVF-PQ')
+    build.add_argument('path')
+    build.add_argument('--nlist', type=int, default=1024)
+    build.add_argument('--m', type=int, default=64)
+    build.add_argument('--sample-size', type=int, default=100000)
+    build.add_argument('--iterations', type=int, default=20)
+    args = parser.parse_args()
+
+    index = EmbeddingIndex(args.path)
+    index.build_quantized(args.nlist, args.m, args.sample_size, args.iterations)
+    print(f"تم بناء فهرس IVF-PQ لـ {len(index)} متجه")
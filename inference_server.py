@@ -0,0 +1,325 @@
+# عامل الاستدلال المنفصل: يمتلك النموذج والتجميع ويتواصل مع خوادم Flask عبر مقبس Unix محلي
+#
+# التشغيل:
+#   python inference_server.py
+# ثم تشغيل خوادم الواجهة مع المتغير INFERENCE_SOCKET:
+#   INFERENCE_SOCKET=/tmp/morox-inference.sock gunicorn -w 8 app:app
+#
+# لتوسيع الاستدلال تُشغّل عدة عمال على مقابس مختلفة، وتوزع خوادم الواجهة الطلبات بينها:
+#   python inference_server.py --socket /tmp/morox-inference-0.sock
+#   python inference_server.py --socket /tmp/morox-inference-1.sock
+#   INFERENCE_SOCKET=/tmp/morox-inference-0.sock,/tmp/morox-inference-1.sock gunicorn -w 8 app:app
+#
+# تنتقل pixel_values عبر الذاكرة المشتركة (shared_memory)، ولا يمر في المقبس
+# سوى اسم المقطع وشكله ونوعه، فلا يتم تسلسل المصفوفة. يبقى نسخ واحد في العميل من
+# مخرجات المعالج إلى المقطع (المعالج يحجز مصفوفته بنفسه ولا يقبل مخزناً خارجياً)،
+# ويقرأ العامل المقطع مباشرة دون نسخ.
+#
+# يملك العامل طابور الاستدلال الوحيد، لذا يتولى التحكم في القبول (admission.py) لكل خوادم
+# الواجهة المتصلة به: ترسل الواجهة أولوية الطلب، ويرد العامل بنمط التوليد أو بالرفض.
+
+import argparse
+import itertools
+import os
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import Future
+from multiprocessing import resource_tracker, shared_memory
+from multiprocessing.connection import Client, Listener
+
+import numpy as np
+from dotenv import load_dotenv
+
+from admission import PRIORITIES, AdmissionController, Overloaded
+
+# تحميل المتغيرات البيئية
+load_dotenv()
+
+INFERENCE_SOCKET = os.getenv('INFERENCE_SOCKET', '/tmp/morox-inference.sock')
+MAX_BATCH_SIZE = int(os.getenv('INFERENCE_MAX_BATCH', '8'))
+BATCH_WAIT_SECONDS = float(os.getenv('INFERENCE_BATCH_WAIT_MS', '10')) / 1000
+
+
+def _attach_shared_memory(name):
+    """الارتباط بمقطع ذاكرة مشتركة أنشأته عملية أخرى دون أن يحذفه متتبع الموارد"""
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    shm = shared_memory.SharedMemory(name=name)
+    # العملية المنشئة هي المسؤولة عن الحذف
+    resource_tracker.unregister(shm._name, 'shared_memory')
+    return shm
+
+
+# نوع طلب خاص يُرجع تضمينات الصور بدلاً من الأوصاف
+EMBEDDING = 'embedding'
+
+
+class _Job:
+    """طلب توليد لصورة (أو دفعة صور) بلغة واحدة أو طلب تضمينات"""
+
+    def __init__(self, pixel_values, language, fast=False):
+        self.pixel_values = pixel_values
+        self.language = language
+        self.fast = fast
+        self.future = Future()
+
+
+class InferenceServer:
+    """خادم يحمل النموذج مرة واحدة ويجمع الطلبات المتزامنة في دفعات"""
+
+    def __init__(self, socket_path=INFERENCE_SOCKET, max_batch_size=MAX_BATCH_SIZE,
+                 batch_wait=BATCH_WAIT_SECONDS):
+        from captioning import GENERATION_SETTINGS, load_image_captioning_model
+
+        self.socket_path = socket_path
+        self.max_batch_size = max_batch_size
+        self.batch_wait = batch_wait
+        self.jobs = queue.Queue()
+        self.processor, self.model = load_image_captioning_model()
+        if self.processor is None or self.model is None:
+            raise RuntimeError("Model not loaded")
+        self.pixel_shape, self.pixel_dtype = self._pixel_layout()
+        # كل طلب وصف مهمة لكل لغة، والدفعة تتسع لـ max_batch_size مهمة
+        self.admission = AdmissionController.from_env(max(1, max_batch_size // len(GENERATION_SETTINGS)))
+
+    def _pixel_layout(self):
+        """شكل صورة واحدة ونوعها كما يخرجان من المعالج، للتحقق من الرسائل قبل دمجها في دفعة"""
+        from PIL import Image
+        from captioning import preprocess_images
+
+        sample = preprocess_images(self.processor, Image.new('RGB', (224, 224)))
+        return tuple(sample.shape[1:]), sample.dtype.str
+
+    def _validate(self, message):
+        """رفض الرسائل التي قد تُفشل الدفعة المشتركة لبقية العملاء"""
+        from captioning import GENERATION_SETTINGS
+
+        shape = tuple(message['shape'])
+        if len(shape) != len(self.pixel_shape) + 1 or shape[0] < 1 or shape[1:] != self.pixel_shape:
+            raise ValueError(f'شكل غير متوقع {shape}، المتوقع (n, {", ".join(map(str, self.pixel_shape))})')
+        if message['dtype'] != self.pixel_dtype:
+            raise ValueError(f"نوع غير متوقع {message['dtype']}، المتوقع {self.pixel_dtype}")
+        languages = list(message['languages'])
+        unknown = [language for language in languages
+                   if language not in GENERATION_SETTINGS and language != EMBEDDING]
+        if not languages or unknown:
+            raise ValueError(f'لغات غير معروفة: {unknown or languages}')
+        priority = message.get('priority')
+        if priority is not None and priority not in PRIORITIES:
+            raise ValueError(f'فئة أولوية غير معروفة: {priority}')
+        return shape, languages, priority
+
+    def serve_forever(self):
+        """استقبال اتصالات خوادم الواجهة"""
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+        threading.Thread(target=self._batch_loop, daemon=True).start()
+
+        with Listener(self.socket_path, family='AF_UNIX') as listener:
+            print(f"عامل الاستدلال يستمع على: {self.socket_path}")
+            while True:
+                conn = listener.accept()
+                threading.Thread(target=self._handle_connection, args=(conn,), daemon=True).start()
+
+    def _handle_connection(self, conn):
+        """خدمة اتصال واحد من خادم واجهة حتى إغلاقه"""
+        with conn:
+            while True:
+                try:
+                    message = conn.recv()
+                except (EOFError, OSError):
+                    return
+                conn.send(self._handle_message(message))
+
+    def _handle_message(self, message):
+        """معالجة رسالة وصف: القبول، ربط الذاكرة المشتركة وانتظار نتائج الدفعات"""
+        # أي خطأ هنا يُعاد كرسالة خطأ، فلو خرج من الخيط لأغلق الاتصال وأعاد العميل الإرسال عبثاً
+        shm = pixel_values = jobs = ticket = None
+        try:
+            shape, languages, priority = self._validate(message)
+            fast = bool(message.get('fast', False))
+            if priority is not None:
+                try:
+                    ticket = self.admission.reserve(priority)
+                except Overloaded as e:
+                    return {'overloaded': e.retry_after}
+                ticket.wait()
+                fast = ticket.fast
+
+            started = time.monotonic()
+            shm = _attach_shared_memory(message['shm'])
+            # عرض مباشر على الذاكرة المشتركة بدون نسخ
+            pixel_values = np.ndarray(shape, dtype=self.pixel_dtype, buffer=shm.buf)
+            jobs = {
+                language: _Job(pixel_values, language, fast)
+                for language in languages
+            }
+            for job in jobs.values():
+                self.jobs.put(job)
+
+            result = {}
+            for language, job in jobs.items():
+                try:
+                    result[language] = job.future.result()
+                except Exception as e:
+                    result[language] = {'error': str(e)}
+
+            if ticket is not None:
+                # زمن الخدمة داخل العامل (انتظار الدفعة والتوليد)، فقط لطلبات الوصف الناجحة
+                failed = any(isinstance(value, dict) for value in result.values())
+                if EMBEDDING not in languages and not failed:
+                    ticket.service_time = time.monotonic() - started
+                result['fast'] = ticket.fast
+            return result
+        except Exception as e:
+            return {'error': f'رسالة غير صالحة: {str(e)}'}
+        finally:
+            # يجب تحرير كل العروض على المقطع قبل إغلاقه
+            pixel_values = jobs = None
+            if shm is not None:
+                shm.close()
+            if ticket is not None:
+                self.admission.release(ticket)
+
+    def _collect_batch(self):
+        """انتظار أول طلب ثم جمع ما يصل خلال نافذة التجميع"""
+        batch = [self.jobs.get()]
+        deadline = time.monotonic() + self.batch_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.jobs.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _batch_loop(self):
+        """حلقة الاستدلال: تجمع الطلبات حسب اللغة ونمط التوليد وتشغّل generate مرة لكل مجموعة"""
+        from captioning import compute_embeddings, generate_descriptions
+
+        while True:
+            batch = self._collect_batch()
+            groups = {}
+            for job in batch:
+                groups.setdefault((job.language, job.fast), []).append(job)
+
+            for (language, fast), jobs in groups.items():
+                try:
+                    if len(jobs) == 1:
+                        pixel_values = jobs[0].pixel_values
+                    else:
+                        pixel_values = np.concatenate([job.pixel_values for job in jobs])
+                    if language == EMBEDDING:
+                        descriptions = compute_embeddings(self.model, pixel_values)
+                    else:
+                        descriptions = generate_descriptions(
+                            self.processor, self.model, pixel_values, language, fast
+                        )
+                except Exception as e:
+                    pixel_values = None
+                    for job in jobs:
+                        job.pixel_values = None
+                        job.future.set_exception(e)
+                    continue
+
+                # تحرير العروض على الذاكرة المشتركة قبل إيقاظ خيط الاتصال
+                pixel_values = None
+                offset = 0
+                for job in jobs:
+                    count = job.pixel_values.shape[0]
+                    job.pixel_values = None
+                    job.future.set_result(descriptions[offset:offset + count])
+                    offset += count
+
+
+class InferenceClient:
+    """عميل يستخدمه خادم Flask لإرسال pixel_values إلى عامل استدلال أو أكثر"""
+
+    def __init__(self, socket_paths=INFERENCE_SOCKET):
+        # مسار واحد أو عدة مسارات مفصولة بفواصل (عامل لكل مقبس)
+        if isinstance(socket_paths, str):
+            socket_paths = socket_paths.split(',')
+        self.socket_paths = [path.strip() for path in socket_paths if path.strip()]
+        if not self.socket_paths:
+            raise ValueError("لم يُحدد مقبس عامل الاستدلال")
+        self._next_socket = itertools.count()
+        self._local = threading.local()
+
+    def _connection(self, socket_path):
+        """اتصال مستقل لكل خيط من خيوط الواجهة ولكل عامل"""
+        connections = getattr(self._local, 'connections', None)
+        if connections is None:
+            connections = self._local.connections = {}
+        conn = connections.get(socket_path)
+        if conn is None:
+            conn = Client(socket_path, family='AF_UNIX')
+            connections[socket_path] = conn
+        return conn
+
+    def _send(self, message):
+        """إرسال الرسالة إلى العامل التالي بالتناوب، والانتقال إلى التالي إذا انقطع الاتصال"""
+        start = next(self._next_socket)
+        # محاولة إضافية حتى يُعاد الاتصال بعامل أُعيد تشغيله عندما يكون هناك عامل واحد
+        attempts = max(len(self.socket_paths), 2)
+        for attempt in range(attempts):
+            socket_path = self.socket_paths[(start + attempt) % len(self.socket_paths)]
+            try:
+                conn = self._connection(socket_path)
+                conn.send(message)
+                return conn.recv()
+            except (EOFError, OSError):
+                stale = self._local.connections.pop(socket_path, None)
+                if stale is not None:
+                    stale.close()
+                if attempt == attempts - 1:
+                    raise
+
+    def describe(self, pixel_values, languages=('english', 'arabic'), fast=False, ticket=None):
+        """إرجاع قاموس {اللغة: [أوصاف]} لدفعة pixel_values (تُنسخ مرة واحدة إلى الذاكرة المشتركة)
+
+        مع تذكرة DeferredAdmission يقرر العامل نمط التوليد ويُحدّث ticket.fast، أو يرفع Overloaded.
+        """
+        pixel_values = np.ascontiguousarray(pixel_values)
+        shm = shared_memory.SharedMemory(create=True, size=max(pixel_values.nbytes, 1))
+        try:
+            shared = np.ndarray(pixel_values.shape, dtype=pixel_values.dtype, buffer=shm.buf)
+            shared[...] = pixel_values
+            del shared
+
+            result = self._send({
+                'shm': shm.name,
+                'shape': pixel_values.shape,
+                'dtype': pixel_values.dtype.str,
+                'languages': list(languages),
+                'fast': fast,
+                'priority': ticket.priority if ticket is not None else None,
+            })
+        finally:
+            shm.close()
+            shm.unlink()
+
+        if 'overloaded' in result:
+            raise Overloaded(result['overloaded'])
+        if 'error' in result:
+            raise RuntimeError(result['error'])
+        if ticket is not None:
+            ticket.fast = result.pop('fast', ticket.fast)
+        for language in languages:
+            if isinstance(result.get(language), dict):
+                raise RuntimeError(result[language]['error'])
+        return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='عامل الاستدلال المنفصل')
+    parser.add_argument('--socket', default=INFERENCE_SOCKET,
+                        help='مسار مقبس Unix لهذا العامل (افتراضياً INFERENCE_SOCKET)')
+    args = parser.parse_args()
+    if ',' in args.socket:
+        raise SystemExit("يستمع كل عامل على مقبس واحد؛ استخدم --socket لكل عامل")
+    InferenceServer(args.socket).serve_forever()
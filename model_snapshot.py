@@ -0,0 +1,253 @@
+# لقطة جاهزة للنموذج والمعالج لتسريع بدء التشغيل
+#
+# بدلاً من from_pretrained (تحليل الإعدادات، فك تسلسل الأوزان، تهيئة الوحدات في كل مرة)
+# تُحفظ اللقطة كالتالي:
+#   meta.json           الإصدارات وإعدادات النموذج والتوليد
+#   processor.pkl       المعالج بعد بنائه
+#   weights.json        اسم كل موتر وموضعه وشكله ونوعه (مع الأسماء المرتبطة بنفس الموتر)
+#   weights.bin         كل الأوزان والمخازن متجاورة ومحاذاة على 64 بايت
+#
+# عند التحميل يُبنى هيكل النموذج مع تعطيل دوال التهيئة (ذاكرة محجوزة لا تُلمس صفحاتها)، ثم
+# تُستبدل الموترات بعروض مباشرة على ملف weights.bin عبر memmap بنمط النسخ عند الكتابة، فتُقرأ
+# الصفحات من القرص عند أول استخدام فقط وتتشاركها العمليات عبر ذاكرة التخزين المؤقت للنظام.
+# (لا يُستخدم الجهاز meta لأن بناء الوحدات عليه يستورد مكتبات torch البطيئة عند أول تشغيل.)
+#
+# الاستخدام:
+#   python model_snapshot.py save /srv/snapshots/git-base-coco
+#   MODEL_SNAPSHOT=/srv/snapshots/git-base-coco python app.py
+#   python model_snapshot.py benchmark /srv/snapshots/git-base-coco
+
+import argparse
+import contextlib
+import json
+import os
+import pickle
+import statistics
+import subprocess
+import sys
+
+import numpy as np
+import torch
+import transformers
+from transformers import CONFIG_MAPPING, AutoModelForVision2Seq, GenerationConfig
+from transformers.modeling_utils import no_init_weights
+
+SNAPSHOT_FORMAT = 1
+ALIGNMENT = 64
+
+
+def _named_tensors(model):
+    """كل المعاملات والمخازن (بما فيها غير الدائمة) مع الأسماء المكررة للموترات المرتبطة"""
+    yield from model.named_parameters(remove_duplicate=False)
+    yield from model.named_buffers(remove_duplicate=False)
+
+
+def save_snapshot(processor, model, path):
+    """حفظ المعالج والنموذج بصيغة اللقطة"""
+    os.makedirs(path, exist_ok=True)
+
+    with open(os.path.join(path, 'processor.pkl'), 'wb') as f:
+        pickle.dump(processor, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    entries, aliases, seen = [], {}, {}
+    offset = 0
+    with open(os.path.join(path, 'weights.bin'), 'wb') as f:
+        for name, tensor in _named_tensors(model):
+            if tensor is None:
+                continue
+            # الأوزان المرتبطة (مثل مصفوفة الإخراج والتضمين) تُحفظ مرة واحدة
+            key = (tensor.data_ptr(), tensor.dtype, tuple(tensor.shape))
+            if key in seen:
+                aliases[name] = seen[key]
+                continue
+            seen[key] = name
+
+            data = tensor.detach().contiguous().cpu()
+            padding = -offset % ALIGNMENT
+            f.write(b'\0' * padding)
+            offset += padding
+            raw = data.reshape(-1).view(torch.uint8).numpy().tobytes()
+            f.write(raw)
+            entries.append({
+                'name': name,
+                'offset': offset,
+                'shape': list(data.shape),
+                'dtype': str(data.dtype).replace('torch.', ''),
+                'parameter': isinstance(tensor, torch.nn.Parameter),
+            })
+            offset += len(raw)
+
+    with open(os.path.join(path, 'weights.json'), 'w') as f:
+        json.dump({'tensors': entries, 'aliases': aliases}, f)
+
+    # يُكتب meta.json أخيراً ليدل على اكتمال اللقطة
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump({
+            'format': SNAPSHOT_FORMAT,
+            'torch': torch.__version__,
+            'transformers': transformers.__version__,
+            'config': model.config.to_dict(),
+            'generation_config': model.generation_config.to_dict(),
+        }, f)
+
+
+@contextlib.contextmanager
+def _skip_init():
+    """تعطيل دوال التهيئة أثناء بناء الهيكل، فالأوزان ستُستبدل على أي حال"""
+    names = [
+        name for name in dir(torch.nn.init)
+        if name.endswith('_') and not name.startswith('_') and callable(getattr(torch.nn.init, name))
+    ]
+    originals = {name: getattr(torch.nn.init, name) for name in names}
+    for name in names:
+        setattr(torch.nn.init, name, lambda tensor, *args, **kwargs: tensor)
+    try:
+        with no_init_weights():
+            yield
+    finally:
+        for name, function in originals.items():
+            setattr(torch.nn.init, name, function)
+
+
+def _set_tensor(model, name, tensor, parameter):
+    """استبدال الموتر غير المهيأ بعرض اللقطة داخل الوحدة المالكة له"""
+    module_name, _, attribute = name.rpartition('.')
+    module = model.get_submodule(module_name) if module_name else model
+    if parameter:
+        module._parameters[attribute] = tensor
+    else:
+        module._buffers[attribute] = tensor
+
+
+def load_snapshot_processor(path):
+    """تحميل المعالج فقط (لخوادم الواجهة التي لا تحتاج الأوزان)"""
+    with open(os.path.join(path, 'processor.pkl'), 'rb') as f:
+        return pickle.load(f)
+
+
+def load_snapshot(path):
+    """تحميل المعالج والنموذج من لقطة بدون نسخ الأوزان إلى الذاكرة مسبقاً"""
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    if meta['format'] != SNAPSHOT_FORMAT:
+        raise ValueError(f"صيغة اللقطة غير مدعومة: {meta['format']}")
+    if meta['transformers'] != transformers.__version__:
+        raise ValueError(
+            f"اللقطة أُنشئت بإصدار transformers {meta['transformers']}، "
+            f"والإصدار الحالي {transformers.__version__}"
+        )
+
+    processor = load_snapshot_processor(path)
+
+    config = CONFIG_MAPPING[meta['config']['model_type']].from_dict(meta['config'])
+    with _skip_init():
+        model = AutoModelForVision2Seq.from_config(config)
+    # إعدادات التوليد المشتقة من إعدادات النموذج يعيد from_config بناءها كما هي
+    if not meta['generation_config'].get('_from_model_config'):
+        model.generation_config = GenerationConfig.from_dict(meta['generation_config'])
+
+    with open(os.path.join(path, 'weights.json')) as f:
+        index = json.load(f)
+
+    # نمط 'c' (نسخ عند الكتابة): قابل للكتابة لـ torch، والصفحات تُقرأ عند الحاجة فقط
+    buffer = np.memmap(os.path.join(path, 'weights.bin'), dtype=np.uint8, mode='c')
+    tensors = {}
+    for entry in index['tensors']:
+        dtype = getattr(torch, entry['dtype'])
+        count = int(np.prod(entry['shape'], dtype=np.int64))
+        nbytes = count * torch.empty(0, dtype=dtype).element_size()
+        raw = torch.from_numpy(buffer[entry['offset']:entry['offset'] + nbytes])
+        tensor = raw.view(dtype).reshape(entry['shape'])
+        if entry['parameter']:
+            tensor = torch.nn.Parameter(tensor, requires_grad=False)
+        tensors[entry['name']] = tensor
+        _set_tensor(model, entry['name'], tensor, entry['parameter'])
+
+    for alias, name in index['aliases'].items():
+        tensor = tensors[name]
+        _set_tensor(model, alias, tensor, isinstance(tensor, torch.nn.Parameter))
+
+    loaded = set(tensors) | set(index['aliases'])
+    missing = [name for name, tensor in _named_tensors(model) if tensor is not None and name not in loaded]
+    if missing:
+        raise ValueError(f"موترات غير موجودة في اللقطة: {missing[:5]}")
+
+    model.eval()
+    return processor, model
+
+
+_BENCHMARK_SNIPPETS = {
+    'from_pretrained': (
+        "processor = AutoProcessor.from_pretrained({model!r})\n"
+        "model = AutoModelForVision2Seq.from_pretrained({model!r}).eval()\n"
+    ),
+    'snapshot': (
+        "processor, model = load_snapshot({snapshot!r})\n"
+    ),
+}
+
+# تُستورد المكتبات قبل بدء القياس في الحالتين حتى يُقارن التحميل وحده
+_BENCHMARK_TEMPLATE = (
+    "import time\n"
+    "from PIL import Image\n"
+    "from transformers import AutoProcessor, AutoModelForVision2Seq\n"
+    "from captioning import preprocess_images, generate_descriptions\n"
+    "from model_snapshot import load_snapshot\n"
+    "start = time.perf_counter()\n"
+    "{load}"
+    "loaded = time.perf_counter() - start\n"
+    "first = 0.0\n"
+    "if {inference}:\n"
+    "    start = time.perf_counter()\n"
+    "    generate_descriptions(processor, model,\n"
+    "        preprocess_images(processor, Image.new('RGB', (224, 224))), 'english')\n"
+    "    first = time.perf_counter() - start\n"
+    "print(loaded, first)\n"
+)
+
+
+def benchmark(snapshot, model_name, runs, inference):
+    """مقارنة زمن بدء التشغيل في عمليات جديدة: from_pretrained مقابل اللقطة"""
+    for method, load in _BENCHMARK_SNIPPETS.items():
+        code = _BENCHMARK_TEMPLATE.format(
+            load=load.format(model=model_name, snapshot=snapshot), inference=inference
+        )
+        loads, firsts = [], []
+        for _ in range(runs):
+            output = subprocess.run(
+                [sys.executable, '-c', code], check=True, stdout=subprocess.PIPE, text=True,
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+            ).stdout.split()
+            loads.append(float(output[-2]))
+            firsts.append(float(output[-1]))
+
+        line = f"{method:>16}: التحميل {statistics.median(loads):.3f} ث"
+        if inference:
+            line += f"  أول استدلال {statistics.median(firsts):.3f} ث"
+        print(line)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='إنشاء لقطة النموذج وقياس زمن بدء التشغيل')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    save = subparsers.add_parser('save', help='إنشاء لقطة من النموذج المحدد')
+    save.add_argument('path')
+
+    bench = subparsers.add_parser('benchmark', help='مقارنة اللقطة مع from_pretrained')
+    bench.add_argument('path')
+    bench.add_argument('--runs', type=int, default=5)
+    bench.add_argument('--no-inference', action='store_true',
+                       help='قياس التحميل فقط دون أول استدلال (الذي يشمل قراءة الصفحات المؤجلة)')
+    args = parser.parse_args()
+
+    from captioning import MODEL_NAME
+
+    if args.command == 'save':
+        from transformers import AutoProcessor
+        processor = AutoProcessor.from_pretrained(MODEL_NAME)
+        model = AutoModelForVision2Seq.from_pretrained(MODEL_NAME).eval()
+        save_snapshot(processor, model, args.path)
+        print(f"تم حفظ اللقطة في: {args.path}")
+    else:
+        benchmark(args.path, MODEL_NAME, args.runs, not args.no_inference)